@@ -106,6 +106,15 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Cache (Requires Redis). Shared by the web and Celery processes so that
+# background tasks can invalidate cached pages.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDIS_CACHE_URL', 'redis://localhost:6379/1'),
+    }
+}
+
 # Channels layer (Requires Redis)
 # CHANNEL_LAYERS = {
 #     'default': {
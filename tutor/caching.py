@@ -0,0 +1,58 @@
+import hashlib
+from contextlib import contextmanager
+
+from django.core.cache import cache
+
+COURSE_CACHE_TIMEOUT = 60 * 5
+COURSE_LIST_KEY = 'course_list'
+
+AI_ANSWER_TIMEOUT = 60 * 60
+
+QUIZ_PAYLOAD_TIMEOUT = 60 * 60
+
+COURSE_OUTLINE_TIMEOUT = 60 * 60 * 24
+
+# Longer than the slowest expected LLM call, so a crashed worker only blocks generation briefly
+GENERATION_LOCK_TIMEOUT = 60 * 5
+
+def course_detail_key(course_id):
+    return f'course_detail:{course_id}'
+
+def invalidate_course_cache(course_id):
+    """
+    Drops the cached course list and the cached detail page of the given course.
+    """
+    cache.delete_many([COURSE_LIST_KEY, course_detail_key(course_id)])
+
+def ai_answer_key(lesson, message):
+    """
+    Key for an AI assistant answer. It includes the lesson's updated_at so that
+    answers are not reused once the lesson content changes.
+    """
+    digest = hashlib.sha1(message.lower().encode()).hexdigest()
+    return f'ai_answer:{lesson.id}:{lesson.updated_at.timestamp()}:{digest}'
+
+def quiz_payload_key(quiz_id):
+    # v2: the cached value is a (payload, question count) pair
+    return f'quiz_payload:v2:{quiz_id}'
+
+def course_outline_key(topic, model_name):
+    """
+    Key for a generated course outline. Topics are compared case-insensitively.
+    """
+    digest = hashlib.sha1(f'{model_name}:{topic.strip().lower()}'.encode()).hexdigest()
+    return f'course_outline:{digest}'
+
+@contextmanager
+def generation_lock(kind, object_id):
+    """
+    Short-lived lock shared by all processes through the cache, so the same content is not
+    generated twice at once. Yields whether the lock was acquired; only the holder releases it.
+    """
+    key = f'generation_lock:{kind}:{object_id}'
+    acquired = cache.add(key, 1, GENERATION_LOCK_TIMEOUT)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(key)
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.6 on 2026-10-15 04:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0003_moduleprogress'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['module', 'order'], name='lesson_module_order_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.6 on 2026-10-15 04:25
+
+import random
+
+from django.db import migrations, models
+
+
+def shuffle_existing_choices(apps, schema_editor):
+    Question = apps.get_model('tutor', 'Question')
+    Choice = apps.get_model('tutor', 'Choice')
+    choices = []
+    for question in Question.objects.prefetch_related('choices'):
+        question_choices = list(question.choices.all())
+        for display_order, choice in zip(random.sample(range(len(question_choices)), len(question_choices)), question_choices):
+            choice.display_order = display_order
+            choices.append(choice)
+    Choice.objects.bulk_update(choices, ['display_order'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0004_lesson_module_order_idx'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='choice',
+            options={'ordering': ['display_order']},
+        ),
+        migrations.AddField(
+            model_name='choice',
+            name='display_order',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(shuffle_existing_choices, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.6 on 2026-10-15 04:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0005_choice_display_order'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='choice',
+            index=models.Index(condition=models.Q(('is_correct', True)), fields=['question'], name='choice_correct_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['quiz', 'order'], name='q_quiz_order_idx'),
+        ),
+    ]
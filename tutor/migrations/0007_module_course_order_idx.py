@@ -0,0 +1,17 @@
+# Generated by Django 5.2.6 on 2026-10-15 04:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0006_perf_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='module',
+            index=models.Index(fields=['course', 'order'], name='module_course_order_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.6 on 2026-10-15 05:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def link_correct_choices(apps, schema_editor):
+    Question = apps.get_model('tutor', 'Question')
+    Choice = apps.get_model('tutor', 'Choice')
+    correct_choice = Choice.objects.filter(question=OuterRef('pk'), is_correct=True).order_by('id').values('id')[:1]
+    Question.objects.update(correct_choice=Subquery(correct_choice))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0007_module_course_order_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='correct_choice',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='tutor.choice'),
+        ),
+        migrations.RunPython(link_correct_choices, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='choice',
+            name='choice_correct_idx',
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.6 on 2026-10-15 04:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0008_question_correct_choice'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='question',
+            name='correct_choice',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='tutor.choice'),
+        ),
+    ]
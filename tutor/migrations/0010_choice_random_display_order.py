@@ -0,0 +1,39 @@
+# Generated by Django 5.2.6 on 2026-10-15 04:53
+
+import random
+
+import tutor.models
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def shuffle_unordered_choices(apps, schema_editor):
+    # Choices entered in the admin since 0005 all got display_order 0
+    Question = apps.get_model('tutor', 'Question')
+    Choice = apps.get_model('tutor', 'Choice')
+    questions = Question.objects.annotate(
+        choice_count=Count('choices'), order_count=Count('choices__display_order', distinct=True)
+    ).filter(order_count__lt=models.F('choice_count')).prefetch_related('choices')
+    choices = []
+    for question in questions:
+        question_choices = list(question.choices.all())
+        for display_order, choice in zip(random.sample(range(len(question_choices)), len(question_choices)), question_choices):
+            choice.display_order = display_order
+            choices.append(choice)
+    Choice.objects.bulk_update(choices, ['display_order'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0009_question_correct_choice_not_editable'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='choice',
+            name='display_order',
+            field=models.PositiveSmallIntegerField(default=tutor.models.random_display_order, editable=False),
+        ),
+        migrations.RunPython(shuffle_unordered_choices, migrations.RunPython.noop),
+    ]
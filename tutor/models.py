@@ -1,3 +1,5 @@
+import random
+
 from django.db import models
 from django.utils import timezone
 
@@ -19,6 +21,9 @@ class Module(models.Model):
     
     class Meta:
         ordering = ['order']
+        indexes = [
+            models.Index(fields=['course', 'order'], name='module_course_order_idx'),
+        ]
     
     def __str__(self):
         return f"{self.course.title} - {self.title}"
@@ -35,6 +40,9 @@ class Lesson(models.Model):
     
     class Meta:
         ordering = ['order']
+        indexes = [
+            models.Index(fields=['module', 'order'], name='lesson_module_order_idx'),
+        ]
     
     def __str__(self):
         return f"{self.module.title} - {self.title}"
@@ -52,17 +60,36 @@ class Question(models.Model):
     question_text = models.TextField()
     explanation = models.TextField(blank=True)
     order = models.PositiveIntegerField(default=0)
+    # Denormalised from Choice.is_correct so scoring a quiz does not have to join the choices.
+    # Not editable: the tasks and the Choice post_save signal are its only writers
+    correct_choice = models.ForeignKey('Choice', null=True, blank=True, editable=False, on_delete=models.SET_NULL, related_name='+')
     
     class Meta:
         ordering = ['order']
+        indexes = [
+            models.Index(fields=['quiz', 'order'], name='q_quiz_order_idx'),
+        ]
     
     def __str__(self):
         return self.question_text[:50] + "..."
 
+def random_display_order():
+    """
+    Default display order of a choice. Random values shuffle a question's choices even when
+    they are entered one by one, e.g. in the admin.
+    """
+    return random.randint(0, 32767)
+
 class Choice(models.Model):
     question = models.ForeignKey(Question, on_delete=models.CASCADE, related_name='choices')
     choice_text = models.CharField(max_length=200)
     is_correct = models.BooleanField(default=False)
+    # Randomised once at creation so quizzes don't have to shuffle choices on every view.
+    # Not editable, so choices entered in the admin keep their random position
+    display_order = models.PositiveSmallIntegerField(default=random_display_order, editable=False)
+    
+    class Meta:
+        ordering = ['display_order']
     
     def __str__(self):
         return self.choice_text
@@ -1,12 +1,23 @@
 from django.db.models.signals import post_save, post_delete
+from django.core.cache import cache
+from django.db import transaction
 from django.dispatch import receiver
+from django.utils import timezone
 from .models import Course, Module, Lesson, Quiz, Question, Choice, UserProgress, UserQuizAttempt
+from .caching import invalidate_course_cache, quiz_payload_key
 
 @receiver(post_save, sender=Course)
 def update_course_updated_at(sender, instance, **kwargs):
     """Update the updated_at timestamp when a course is saved."""
     Course.objects.filter(id=instance.id).update(updated_at=instance.updated_at)
 
+@receiver(post_save, sender=Course)
+@receiver(post_delete, sender=Course)
+def invalidate_cached_course_pages(sender, instance, **kwargs):
+    """Drop the cached course list and course detail page when a course changes or is deleted."""
+    course_id = instance.id
+    transaction.on_commit(lambda: invalidate_course_cache(course_id))
+
 @receiver(post_save, sender=Module)
 def update_module_course_updated_at(sender, instance, **kwargs):
     """Update the parent course's updated_at when a module is saved."""
@@ -37,29 +48,52 @@ def update_choice_question_updated_at(sender, instance, **kwargs):
     if instance.question and instance.question.quiz and instance.question.quiz.lesson and instance.question.quiz.lesson.module and instance.question.quiz.lesson.module.course:
         instance.question.quiz.lesson.module.course.save()
 
-@receiver(post_save, sender=UserProgress)
-def handle_lesson_completion(sender, instance, created, **kwargs):
-    """Handle actions when a lesson is marked as completed."""
-    if instance.completed:
-        try:
-            # Check if the lesson has a quiz
-            if instance.lesson.quiz:
-                # If the lesson has a quiz, we might want to do something special
-                pass
-        except Quiz.DoesNotExist:
-            # Lesson does not have a quiz, so do nothing related to quiz
-            pass
+@receiver(post_save, sender=Choice)
+def sync_question_correct_choice(sender, instance, **kwargs):
+    """Keep the question's correct_choice in step when a choice is edited, e.g. in the admin."""
+    if instance.is_correct:
+        Question.objects.filter(id=instance.question_id).update(correct_choice=instance)
+    else:
+        Question.objects.filter(id=instance.question_id, correct_choice=instance).update(correct_choice=None)
+
+@receiver(post_save, sender=Quiz)
+@receiver(post_delete, sender=Quiz)
+def invalidate_cached_quiz_payload(sender, instance, **kwargs):
+    """Drop the cached quiz payload when a quiz changes or is deleted."""
+    quiz_id = instance.id
+    transaction.on_commit(lambda: cache.delete(quiz_payload_key(quiz_id)))
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def invalidate_question_quiz_payload(sender, instance, **kwargs):
+    """Drop the cached payload of the quiz a question belongs to."""
+    quiz_id = instance.quiz_id
+    transaction.on_commit(lambda: cache.delete(quiz_payload_key(quiz_id)))
+
+@receiver(post_save, sender=Choice)
+@receiver(post_delete, sender=Choice)
+def invalidate_choice_quiz_payload(sender, instance, **kwargs):
+    """Drop the cached payload of the quiz a choice belongs to."""
+    quiz_id = Question.objects.filter(id=instance.question_id).values_list('quiz_id', flat=True).first()
+    if quiz_id:
+        transaction.on_commit(lambda: cache.delete(quiz_payload_key(quiz_id)))
 
 @receiver(post_save, sender=UserQuizAttempt)
 def handle_quiz_attempt(sender, instance, created, **kwargs):
     """Handle actions when a quiz is attempted."""
     if created and instance.score >= 70:  # If passing score
-        # Mark the lesson as completed
-        UserProgress.objects.update_or_create(
+        # Mark the lesson as completed, without touching a row that already is
+        updated = UserProgress.objects.filter(
             session_key=instance.session_key,
-            lesson=instance.quiz.lesson,
-            defaults={'completed': True}
-        )
+            lesson_id=instance.quiz.lesson_id,
+            completed=False
+        ).update(completed=True, last_reviewed=timezone.now())
+        if not updated:
+            UserProgress.objects.get_or_create(
+                session_key=instance.session_key,
+                lesson_id=instance.quiz.lesson_id,
+                defaults={'completed': True}
+            )
 
 # Connect the signals
 def connect_signals():
@@ -1,15 +1,85 @@
+import asyncio
+import functools
 import json
+import random
 import re
+import weakref
+import httpx
+import orjson
 import requests
 import google.generativeai as genai
-from celery import shared_task
+from requests.adapters import HTTPAdapter
+from celery import group, shared_task
 from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
+from django.utils import timezone
 from .models import Course, Module, Lesson, Quiz, Question, Choice
+from .caching import COURSE_OUTLINE_TIMEOUT, course_outline_key, generation_lock, invalidate_course_cache
 
 # --- OLLAMA AI Configuration ---
 OLLAMA_MODEL = "phi3:mini" # Changed from phi3:3.8b-mini-4k-instruct-q4_0 for faster inference
 
+# One session per process, so calls to Ollama reuse keep-alive connections
+_OLLAMA_SESSION = requests.Session()
+_OLLAMA_SESSION.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+_OLLAMA_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+
+# One AsyncClient per event loop, since its connection pool is bound to the loop it runs on.
+# Under ASGI that is one client per process; entries go away with their loop
+_OLLAMA_ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+
+def get_ollama_async_client():
+    """
+    Returns the httpx client shared by async Ollama calls on the running event loop,
+    so they reuse keep-alive connections.
+    """
+    loop = asyncio.get_running_loop()
+    client = _OLLAMA_ASYNC_CLIENTS.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(timeout=120, limits=httpx.Limits(max_connections=20, max_keepalive_connections=10))
+        _OLLAMA_ASYNC_CLIENTS[loop] = client
+    return client
+
+def ollama_payload(prompt, stream=False):
+    """
+    Builds the JSON body of an Ollama generate request for the given prompt. Regular
+    requests ask for a single JSON object; streamed ones get plain text.
+    """
+    payload = {
+        "model": OLLAMA_MODEL,
+        "prompt": prompt,
+        "stream": stream,
+        "options": {"num_predict": 2048}
+    }
+    if not stream:
+        payload["prompt"] = f"{prompt}\n\nPlease ensure the output is only a single, valid JSON object as requested, with no additional text or markdown."
+        # Constrains generation to valid JSON, so the reply normally parses as is
+        payload["format"] = "json"
+    return payload
+
+def parse_ollama_response(response_text):
+    """
+    Cleans the text generated by Ollama and parses it as JSON.
+    Raises ValueError if no valid JSON object is found.
+    """
+    print(f"Received response from Ollama: {response_text}")
+
+    try:
+        return orjson.loads(response_text)
+    except orjson.JSONDecodeError:
+        pass
+
+    cleaned_text = clean_llm_response(response_text)
+    if not cleaned_text:
+        raise ValueError("Received an empty response from Ollama.")
+
+    try:
+        return orjson.loads(cleaned_text)
+    except orjson.JSONDecodeError as e:
+        print(f"Failed to decode JSON from Ollama: {e}")
+        raise ValueError(f"AI service returned invalid JSON: {e}")
+
 def call_ollama(prompt):
     """
     Sends a prompt to the Ollama API, cleans the response, and parses it as JSON.
@@ -17,40 +87,65 @@ def call_ollama(prompt):
     """
     print(f"Sending prompt to Ollama: {prompt}")
     try:
-        response = requests.post(settings.OLLAMA_URL, json={
-            "model": OLLAMA_MODEL,
-            "prompt": f"{prompt}\n\nPlease ensure the output is only a single, valid JSON object as requested, with no additional text or markdown.",
-            "stream": False,
-            "options": {"num_predict": 2048}
-        }, headers={"Content-Type": "application/json"}, timeout=120) # 120 second timeout
-        
+        response = _OLLAMA_SESSION.post(
+            settings.OLLAMA_URL, json=ollama_payload(prompt),
+            headers={"Content-Type": "application/json"}, timeout=120 # 120 second timeout
+        )
         response.raise_for_status() # Raises HTTPError for bad responses (4xx or 5xx) 
-        
-        response_text = response.json().get('response', '')
-        print(f"Received response from Ollama: {response_text}")
-
-        cleaned_text = clean_llm_response(response_text)
-        if not cleaned_text:
-            raise ValueError("Received an empty response from Ollama.")
-
-        return json.loads(cleaned_text)
-
     except requests.exceptions.RequestException as e:
         print(f"Error calling Ollama: {e}")
         # Re-raise as a more generic exception to be caught by the view or task
         raise ValueError(f"AI service request failed: {e}")
-    except json.JSONDecodeError as e:
-        print(f"Failed to decode JSON from Ollama: {e}")
-        raise ValueError(f"AI service returned invalid JSON: {e}")
+
+    return parse_ollama_response(response.json().get('response', ''))
+
+async def acall_ollama(prompt):
+    """
+    Async version of call_ollama for async views, so a request waiting on the
+    model does not hold a worker thread.
+    """
+    print(f"Sending prompt to Ollama: {prompt}")
+    try:
+        response = await get_ollama_async_client().post(settings.OLLAMA_URL, json=ollama_payload(prompt))
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        print(f"Error calling Ollama: {e}")
+        raise ValueError(f"AI service request failed: {e}")
+
+    return parse_ollama_response(response.json().get('response', ''))
+
+async def astream_ollama(prompt):
+    """
+    Streams the plain text Ollama generates for a prompt, chunk by chunk, as it arrives.
+    Raises ValueError if Ollama reports an error or the stream ends before it is done.
+    """
+    print(f"Streaming prompt to Ollama: {prompt}")
+    client = get_ollama_async_client()
+    async with client.stream("POST", settings.OLLAMA_URL, json=ollama_payload(prompt, stream=True)) as response:
+        response.raise_for_status()
+        # Ollama sends one JSON object per line, each carrying the next piece of text,
+        # and a final one with "done": true. Failures arrive as an "error" line on the same 200 stream
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            chunk = orjson.loads(line)
+            if chunk.get('error'):
+                raise ValueError(f"AI service failed while generating: {chunk['error']}")
+            if chunk.get('response'):
+                yield chunk['response']
+            if chunk.get('done'):
+                return
+    raise ValueError("AI service stream ended before the answer was complete.")
+
+# Regex to find all substrings that look like JSON objects
+JSON_OBJECT_PATTERN = re.compile(r'\{.*?\}', re.DOTALL)
 
 def clean_llm_response(response_text):
     """
     Cleans the raw text response from the LLM by finding all possible JSON objects
     and returning the first one that is valid.
     """
-    # Regex to find all substrings that look like JSON objects
-    json_pattern = re.compile(r'\{.*?\}', re.DOTALL)
-    potential_matches = json_pattern.findall(response_text)
+    potential_matches = JSON_OBJECT_PATTERN.findall(response_text)
 
     if not potential_matches:
         print(f"Warning: Could not find any potential JSON objects in the response: {response_text}")
@@ -59,19 +154,153 @@ def clean_llm_response(response_text):
     for match in potential_matches:
         try:
             # Try to parse the found substring as JSON
-            json.loads(match)
+            orjson.loads(match)
             return match.strip()  # Return the first valid JSON object found
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             continue  # Not a valid JSON object, try the next one
 
     print(f"Warning: Found potential JSON but failed to parse any of them: {response_text}")
     return ""
 
-# --- Celery Tasks ---
+JSON_DECODER = json.JSONDecoder()
+
+def parse_json_block(response_text):
+    """
+    Parses the JSON object embedded in an LLM response, ignoring markdown code fences
+    and any text around it. Raises ValueError if no valid object is found.
+    """
+    try:
+        return orjson.loads(response_text)
+    except orjson.JSONDecodeError:
+        pass
+
+    # Decode a single object from the first '{', ignoring whatever follows it
+    start = response_text.find('{')
+    if start == -1:
+        raise ValueError("AI service response did not contain a JSON object.")
+    return JSON_DECODER.raw_decode(response_text, start)[0]
+
+# --- Gemini AI Configuration ---
+GEMINI_FLASH_MODEL = 'gemini-1.5-flash-latest'
 
-# It's good practice to configure the client within the task
-# to ensure it's initialized in the worker process.
-genai.configure(api_key=settings.GEMINI_API_KEY)
+@functools.lru_cache(maxsize=None)
+def configure_gemini():
+    """
+    Configures the Gemini client once per process, on first use, so it is
+    initialised in the web and worker processes alike.
+    """
+    genai.configure(api_key=settings.GEMINI_API_KEY)
+
+@functools.lru_cache(maxsize=4)
+def get_gemini_model(model_name=GEMINI_FLASH_MODEL, json_output=False):
+    """
+    Returns a shared GenerativeModel for the given model name instead of building one per call.
+    With json_output, the model is asked to reply with JSON only.
+    """
+    configure_gemini()
+    if json_output:
+        return genai.GenerativeModel(model_name, generation_config={'response_mime_type': 'application/json'})
+    return genai.GenerativeModel(model_name)
+
+def generate_course_outline(topic):
+    """
+    Asks the LLM for a course title, description and the modules with their lesson titles.
+    Returns a dict with "course_title", "course_description" and "modules", a list of
+    (module_title, lessons_json) pairs.
+    """
+    # --- Step 1: Generate Course Title and Description ---
+    prompt_title_desc = f"""
+    Generate a course title and a brief description for a course on the topic: '{topic}'.
+    Provide the output as a single JSON object with two keys: "course_title" and "course_description".
+    For example:
+    {{
+        "course_title": "Introduction to Python",
+        "course_description": "A beginner-friendly course on Python."
+    }}
+    """
+    title_desc_json = call_ollama(prompt_title_desc)
+    course_title = title_desc_json.get('course_title') or f"New Course on {topic}"
+
+    # --- Step 2: Generate Module Titles ---
+    prompt_modules = f"""
+    For a course titled '{course_title}', generate a list of 5 to 7 relevant module titles.
+    Provide the output as a single JSON object with one key: "module_titles", which contains a list of strings.
+    For example:
+    {{
+        "module_titles": ["Getting Started", "Data Structures", "Control Flow"]
+    }}
+    """
+    module_titles_json = call_ollama(prompt_modules)
+    module_titles = module_titles_json.get('module_titles', [])
+
+    # --- Step 3: Ask for the objective and lesson titles of every module ---
+    module_outlines = []
+    for module_title in module_titles:
+        prompt_lessons = f"""
+        For a module named '{module_title}' in a course about '{topic}', generate a concise learning objective and a list of 3-5 lesson titles.
+        Provide the output as a single JSON object with two keys: "objective" and "lesson_titles".
+        For example:
+        {{
+            "objective": "Understand the basics of Python syntax.",
+            "lesson_titles": ["Variables and Data Types", "Your First Python Script"]
+        }}
+        """
+        module_outlines.append((module_title, call_ollama(prompt_lessons)))
+
+    return {
+        'course_title': course_title,
+        'course_description': title_desc_json.get('course_description'),
+        'modules': module_outlines,
+    }
+
+def build_choices(question, options, answer):
+    """
+    Builds the unsaved Choice rows of a question, each with a random display order.
+    """
+    display_orders = random.sample(range(len(options)), len(options))
+    return [
+        Choice(
+            question=question,
+            choice_text=choice_text,
+            is_correct=(choice_text == answer),
+            display_order=display_order
+        )
+        for choice_text, display_order in zip(options, display_orders)
+    ]
+
+def link_correct_choices(choices):
+    """
+    Stores the correct choice of each question on the question itself, from freshly created choices.
+    """
+    questions = []
+    for choice in choices:
+        if choice.is_correct:
+            choice.question.correct_choice = choice
+            questions.append(choice.question)
+    Question.objects.bulk_update(questions, ['correct_choice'])
+
+def quiz_title(lesson):
+    """
+    Title of a lesson's generated quiz, cut to fit Quiz.title when the lesson title is near its limit.
+    """
+    return f"Quiz for {lesson.title}"[:Quiz._meta.get_field('title').max_length]
+
+def is_valid_lesson_json(lesson_json):
+    """
+    Checks that a generated lesson has content and a usable multiple-choice question
+    whose options fit in Choice.choice_text.
+    """
+    max_option_length = Choice._meta.get_field('choice_text').max_length
+    return (
+        isinstance(lesson_json, dict)
+        and isinstance(lesson_json.get('lesson_content'), str) and lesson_json['lesson_content'].strip() != ''
+        and isinstance(lesson_json.get('quiz_question'), str)
+        and isinstance(lesson_json.get('options'), list) and len(lesson_json['options']) > 1
+        and all(isinstance(option, str) and len(option) <= max_option_length for option in lesson_json['options'])
+        and lesson_json.get('answer') in lesson_json['options']
+    )
+
+# --- Celery Tasks ---
 
 @shared_task
 def generate_modules_and_lessons(course_id, topic):
@@ -82,65 +311,52 @@ def generate_modules_and_lessons(course_id, topic):
     try:
         course = Course.objects.get(id=course_id)
 
-        # --- Step 1: Generate Course Title and Description ---
-        prompt_title_desc = f"""
-        Generate a course title and a brief description for a course on the topic: '{topic}'.
-        Provide the output as a single JSON object with two keys: "course_title" and "course_description".
-        For example:
-        {{
-            "course_title": "Introduction to Python",
-            "course_description": "A beginner-friendly course on Python."
-        }}
-        """
-        title_desc_json = call_ollama(prompt_title_desc)
-        
+        # Reuse the outline of an earlier course on the same topic instead of calling the LLM again
+        outline_key = course_outline_key(topic, OLLAMA_MODEL)
+        outline = cache.get(outline_key)
+        if outline is None:
+            outline = generate_course_outline(topic)
+            if outline['modules']:
+                cache.set(outline_key, outline, COURSE_OUTLINE_TIMEOUT)
+
         # Update the placeholder course with the real title and description
-        course.title = title_desc_json.get('course_title', course.title)
-        course.description = title_desc_json.get('course_description', course.description)
+        course.title = outline['course_title']
+        course.description = outline['course_description'] or course.description
         course.save()
 
-        # --- Step 2: Generate Module Titles ---
-        prompt_modules = f"""
-        For a course titled '{course.title}', generate a list of 5 to 7 relevant module titles.
-        Provide the output as a single JSON object with one key: "module_titles", which contains a list of strings.
-        For example:
-        {{
-            "module_titles": ["Getting Started", "Data Structures", "Control Flow"]
-        }}
-        """
-        module_titles_json = call_ollama(prompt_modules)
-        module_titles = module_titles_json.get('module_titles', [])
-
-        lessons_to_generate_async = []
-
-        # --- Step 3 & 4: Loop through modules to get lessons and create everything ---
-        for i, module_title in enumerate(module_titles):
-            prompt_lessons = f"""
-            For a module named '{module_title}' in a course about '{topic}', generate a concise learning objective and a list of 3-5 lesson titles.
-            Provide the output as a single JSON object with two keys: "objective" and "lesson_titles".
-            For example:
-            {{
-                "objective": "Understand the basics of Python syntax.",
-                "lesson_titles": ["Variables and Data Types", "Your First Python Script"]
-            }}
-            """
-            lessons_json = call_ollama(prompt_lessons)
-            
-            with transaction.atomic():
-                module = Module.objects.create(
+        module_outlines = outline['modules']
+
+        # --- Step 4: Create all modules and lessons with one INSERT each ---
+        with transaction.atomic():
+            modules = Module.objects.bulk_create([
+                Module(
                     course=course,
                     title=module_title,
                     description=lessons_json.get('objective', ''),
                     order=i
                 )
+                for i, (module_title, lessons_json) in enumerate(module_outlines)
+            ])
 
-                for j, lesson_title in enumerate(lessons_json.get('lesson_titles', [])):
-                    lesson = Lesson.objects.create(module=module, title=lesson_title, content="", order=j)
-                    lessons_to_generate_async.append(lesson.id)
-        
-        # --- Step 5: Trigger async tasks for lesson content generation ---
-        for lesson_id in lessons_to_generate_async:
-            generate_lesson_content.delay(lesson_id)
+            lessons = Lesson.objects.bulk_create([
+                Lesson(module=module, title=lesson_title, content="", order=j)
+                for module, (_, lessons_json) in zip(modules, module_outlines)
+                for j, lesson_title in enumerate(lessons_json.get('lesson_titles', []))
+            ])
+
+            # bulk_create skips post_save, so drop the cached course pages explicitly
+            transaction.on_commit(lambda: invalidate_course_cache(course.id))
+
+            # --- Step 5: Trigger async tasks for lesson content generation ---
+            # One task per module, each generating all of its lessons with a single request.
+            # Dispatched as one group once the lessons are committed, so workers never see missing rows
+            lesson_ids_by_module = {}
+            for lesson in lessons:
+                lesson_ids_by_module.setdefault(lesson.module_id, []).append(lesson.id)
+            transaction.on_commit(lambda: group(
+                generate_module_lessons.s(module_id, lesson_ids)
+                for module_id, lesson_ids in lesson_ids_by_module.items()
+            ).apply_async())
 
         return f"Successfully generated modules and lessons for course {course_id}."
 
@@ -158,13 +374,19 @@ def generate_lesson_content(lesson_id):
     """
     Background task to generate content and a quiz for a single lesson.
     """
+    with generation_lock('lesson', lesson_id) as acquired:
+        if not acquired:
+            return f"Lesson {lesson_id} is already being generated."
+        return _generate_lesson_content(lesson_id)
+
+def _generate_lesson_content(lesson_id):
     lesson = None
     try:
         lesson = Lesson.objects.get(id=lesson_id)
         if lesson.content:
             return f"Lesson {lesson_id} already has content."
 
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
+        model = get_gemini_model(json_output=True)
         prompt = f"""
         You are an expert educator. Generate the content for a lesson titled \"{lesson.title}\" within the module \"{lesson.module.title}\".
         The module's objective is: {lesson.module.description}
@@ -176,25 +398,25 @@ def generate_lesson_content(lesson_id):
         - \"answer\": The correct choice from the options list.
         """
         response = model.generate_content(prompt)
-        cleaned_response = response.text.strip().replace('`', '').replace('json', '', 1)
-        ai_response_json = json.loads(cleaned_response)
+        ai_response_json = parse_json_block(response.text)
 
         with transaction.atomic():
+            # Lock the lesson row and re-check it, in case another worker filled it in the meantime
+            locked = Lesson.objects.select_for_update().only('content').get(id=lesson_id)
+            if locked.content:
+                return f"Lesson {lesson_id} already has content."
             lesson.content = ai_response_json['lesson_content']
             lesson.save()
 
-            quiz = Quiz.objects.create(lesson=lesson, title=f"Quiz for {lesson.title}")
+            quiz = Quiz.objects.create(lesson=lesson, title=quiz_title(lesson))
             question = Question.objects.create(
                 quiz=quiz,
                 question_text=ai_response_json['quiz_question'],
                 order=0
             )
-            for choice_text in ai_response_json['options']:
-                Choice.objects.create(
-                    question=question,
-                    choice_text=choice_text,
-                    is_correct=(choice_text == ai_response_json['answer'])
-                )
+            choices = build_choices(question, ai_response_json['options'], ai_response_json['answer'])
+            Choice.objects.bulk_create(choices, batch_size=100)
+            link_correct_choices(choices)
         return f"Successfully generated content for lesson {lesson_id}."
 
     except Lesson.DoesNotExist:
@@ -203,4 +425,97 @@ def generate_lesson_content(lesson_id):
         if lesson:
             lesson.content = f"### Error Generating Content\n\nWe encountered an issue while preparing this lesson: `{str(e)}`\n\nPlease try refreshing later or contact support."
             lesson.save()
-        return f"Failed to generate content for lesson {lesson_id}: {str(e)}"
\ No newline at end of file
+        return f"Failed to generate content for lesson {lesson_id}: {str(e)}"
+
+@shared_task
+def generate_module_lessons(module_id, lesson_ids):
+    """
+    Background task to generate the content and quiz of several lessons of one module
+    with a single Gemini request. Lessons that are missing or invalid in the response
+    are handed over to generate_lesson_content one by one.
+    """
+    with generation_lock('module', module_id) as acquired:
+        if not acquired:
+            return f"Lessons of module {module_id} are already being generated."
+        return _generate_module_lessons(module_id, lesson_ids)
+
+def _generate_module_lessons(module_id, lesson_ids):
+    lessons = {
+        str(lesson.id): lesson
+        for lesson in Lesson.objects.filter(id__in=lesson_ids, module_id=module_id, content='').select_related('module').order_by('order')
+    }
+    if not lessons:
+        return f"Lessons of module {module_id} already have content."
+    module = next(iter(lessons.values())).module
+
+    generated = {}
+    try:
+        lesson_list = "\n".join(f'- {lesson_id}: "{lesson.title}"' for lesson_id, lesson in lessons.items())
+        prompt = f"""
+        You are an expert educator. Generate the content for each of the following lessons within the module \"{module.title}\".
+        The module's objective is: {module.description}
+
+        Lessons (id: title):
+        {lesson_list}
+
+        The output must be a JSON object with a single key \"lessons\", a list containing one object per lesson with the following structure:
+        - \"lesson_id\": The id of the lesson, as given above.
+        - \"lesson_content\": The full lesson content in Markdown format. It should be detailed, clear, and easy to understand.
+        - \"quiz_question\": A multiple-choice question to test the core concept of the lesson.
+        - \"options\": A list of 4 strings representing the choices for the multiple-choice question.
+        - \"answer\": The correct choice from the options list.
+        """
+        response = get_gemini_model(json_output=True).generate_content(prompt)
+        for lesson_json in parse_json_block(response.text).get('lessons', []):
+            # Each lesson is validated on its own so one bad entry doesn't discard the rest
+            if is_valid_lesson_json(lesson_json) and str(lesson_json.get('lesson_id')) in lessons:
+                generated[str(lesson_json['lesson_id'])] = lesson_json
+    except Exception as e:
+        print(f"Batched lesson generation failed for module {module_id}: {e}")
+
+    try:
+        with transaction.atomic():
+            # Only write lessons that are still empty once locked, in case another worker got to them first
+            still_empty = Lesson.objects.select_for_update().filter(id__in=list(generated), content='').values_list('id', flat=True)
+            generated = {lesson_id: generated[lesson_id] for lesson_id in map(str, still_empty)}
+            if generated:
+                _save_generated_lessons(lessons, generated)
+    except Exception as e:
+        # The whole batch was rolled back, so every lesson goes through the per-lesson task,
+        # which records its own error instead of leaving the lesson on the placeholder
+        print(f"Saving batched lessons failed for module {module_id}: {e}")
+        generated = {}
+
+    # Anything the batched response didn't cover falls back to one request per lesson
+    missing = [lesson.id for lesson_id, lesson in lessons.items() if lesson_id not in generated]
+    if missing:
+        transaction.on_commit(lambda: group(generate_lesson_content.s(lesson_id) for lesson_id in missing).apply_async())
+
+    return f"Generated {len(generated)} of {len(lessons)} lessons for module {module_id} in one request."
+
+def _save_generated_lessons(lessons, generated):
+    """
+    Writes the content, quiz, question and choices of each generated lesson with bulk queries.
+    """
+    now = timezone.now()
+    generated_lessons = []
+    for lesson_id, lesson_json in generated.items():
+        lesson = lessons[lesson_id]
+        lesson.content = lesson_json['lesson_content']
+        lesson.updated_at = now  # bulk_update skips auto_now
+        generated_lessons.append(lesson)
+    Lesson.objects.bulk_update(generated_lessons, ['content', 'updated_at'])
+
+    quizzes = Quiz.objects.bulk_create([
+        Quiz(lesson=lesson, title=quiz_title(lesson)) for lesson in generated_lessons
+    ])
+    questions = Question.objects.bulk_create([
+        Question(quiz=quiz, question_text=generated[str(quiz.lesson_id)]['quiz_question'], order=0)
+        for quiz in quizzes
+    ])
+    choices = []
+    for question in questions:
+        lesson_json = generated[str(question.quiz.lesson_id)]
+        choices.extend(build_choices(question, lesson_json['options'], lesson_json['answer']))
+    Choice.objects.bulk_create(choices, batch_size=100)
+    link_correct_choices(choices)
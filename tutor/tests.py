@@ -0,0 +1,280 @@
+from unittest import mock
+
+import httpx
+import orjson
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from . import tasks
+from .caching import generation_lock
+from .models import Course, Module, Lesson, Quiz, Question, Choice, UserQuizAttempt
+from .views import _adjacent_lesson
+
+# The tests must not depend on a running Redis server
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class QueryCountTests(TestCase):
+    """
+    Pins the number of queries on the hot paths, so an added lazy load shows up as a failure.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(title='Python', description='A course on Python.')
+        cls.lessons = []
+        for module_order in range(2):
+            module = Module.objects.create(course=cls.course, title=f'Module {module_order}', order=module_order)
+            for lesson_order in range(3):
+                cls.lessons.append(Lesson.objects.create(
+                    module=module, title=f'Lesson {module_order}.{lesson_order}', content='Content', order=lesson_order
+                ))
+
+        cls.quiz = Quiz.objects.create(lesson=cls.lessons[0], title='Quiz')
+        cls.correct_choices = {}
+        for order in range(2):
+            question = Question.objects.create(quiz=cls.quiz, question_text=f'Question {order}', order=order)
+            for choice_order, is_correct in enumerate((False, True, False)):
+                choice = Choice.objects.create(
+                    question=question, choice_text=f'Choice {choice_order}', is_correct=is_correct, display_order=choice_order
+                )
+                if is_correct:
+                    cls.correct_choices[question.id] = choice.id
+
+    def setUp(self):
+        cache.clear()
+
+    def test_course_detail_queries(self):
+        url = reverse('tutor:course_detail', args=[self.course.id])
+        # Course, modules and their prefetched lessons on a miss
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # Served entirely from the cache on a hit
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertContains(response, 'Module 1')
+
+    def test_quiz_detail_queries(self):
+        url = reverse('tutor:quiz_detail', args=[self.quiz.id])
+        # Quiz with its breadcrumbs, questions, and their prefetched choices on a miss
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertContains(response, 'This quiz contains 2 questions.')
+        # Only the quiz with its breadcrumbs on a hit; the payload and question count are cached
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertContains(response, 'This quiz contains 2 questions.')
+        self.assertContains(response, 'Question 1')
+
+    def test_adjacent_lesson_crosses_modules_in_one_query(self):
+        last_of_first_module, first_of_second_module = self.lessons[2], self.lessons[3]
+        with self.assertNumQueries(1):
+            next_lesson = _adjacent_lesson(self.course.id, 0, last_of_first_module.order)
+        self.assertEqual(next_lesson, {'id': first_of_second_module.id, 'module_id': first_of_second_module.module_id})
+        with self.assertNumQueries(1):
+            prev_lesson = _adjacent_lesson(self.course.id, 1, first_of_second_module.order, forward=False)
+        self.assertEqual(prev_lesson, {'id': last_of_first_module.id, 'module_id': last_of_first_module.module_id})
+        with self.assertNumQueries(1):
+            self.assertIsNone(_adjacent_lesson(self.course.id, 0, 0, forward=False))
+
+    def test_submit_quiz_scores_in_a_single_query(self):
+        answers = {str(question_id): str(choice_id) for question_id, choice_id in self.correct_choices.items()}
+        first_question_id = next(iter(answers))
+        answers[first_question_id] = '0'
+        # Quiz lookup, correct choice ids, and the attempt insert; inside TestCase's transaction
+        # the view's atomic block adds a SAVEPOINT and its RELEASE
+        with self.assertNumQueries(5):
+            response = self.client.post(
+                reverse('tutor:submit_quiz', args=[self.quiz.id]),
+                orjson.dumps({'answers': answers}),
+                content_type='application/json'
+            )
+        self.assertEqual(orjson.loads(response.content), {
+            'success': True, 'score': 50.0, 'correct_answers': 1, 'total_questions': 2, 'passed': False
+        })
+        self.assertEqual(UserQuizAttempt.objects.get().score, 50.0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ModuleLessonGenerationTests(TestCase):
+    """
+    The batched generation task writes what it can and hands every other lesson to
+    the per-lesson task, so no lesson is left without content.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        course = Course.objects.create(title='Python', description='A course on Python.')
+        cls.module = Module.objects.create(course=course, title='Basics', description='Learn the basics.')
+        cls.lessons = [
+            Lesson.objects.create(module=cls.module, title=f'Lesson {order}', order=order) for order in range(2)
+        ]
+
+    def setUp(self):
+        cache.clear()
+
+    def lesson_json(self, lesson, **overrides):
+        return {
+            'lesson_id': lesson.id,
+            'lesson_content': f'Content of {lesson.title}',
+            'quiz_question': 'Which one?',
+            'options': ['A', 'B', 'C', 'D'],
+            'answer': 'B',
+            **overrides,
+        }
+
+    def run_task(self, lessons_json):
+        """
+        Runs generate_module_lessons against a faked Gemini reply and returns the lesson
+        ids handed over to generate_lesson_content.
+        """
+        model = mock.Mock()
+        model.generate_content.return_value.text = orjson.dumps({'lessons': lessons_json}).decode()
+        with mock.patch.object(tasks, 'get_gemini_model', return_value=model), \
+                mock.patch.object(tasks, 'group') as group, \
+                self.captureOnCommitCallbacks(execute=True):
+            tasks.generate_module_lessons(self.module.id, [lesson.id for lesson in self.lessons])
+        if not group.called:
+            return []
+        return [signature.args[0] for signature in group.call_args.args[0]]
+
+    def test_invalid_entries_fall_back_to_the_per_lesson_task(self):
+        first, second = self.lessons
+        fallback = self.run_task([
+            self.lesson_json(first),
+            # An option longer than Choice.choice_text allows
+            self.lesson_json(second, options=['A', 'B' * 201], answer='A'),
+        ])
+
+        self.assertEqual(fallback, [second.id])
+        first.refresh_from_db()
+        self.assertEqual(first.content, 'Content of Lesson 0')
+        question = first.quiz.questions.get()
+        self.assertEqual(question.correct_choice.choice_text, 'B')
+        self.assertFalse(Quiz.objects.filter(lesson=second).exists())
+
+    def test_failed_write_hands_every_lesson_to_the_per_lesson_task(self):
+        with mock.patch.object(tasks, 'link_correct_choices', side_effect=RuntimeError('write failed')):
+            fallback = self.run_task([self.lesson_json(lesson) for lesson in self.lessons])
+
+        self.assertEqual(sorted(fallback), sorted(lesson.id for lesson in self.lessons))
+        self.assertFalse(Lesson.objects.exclude(content='').exists())
+        self.assertFalse(Quiz.objects.exists())
+
+    def test_quiz_title_fits_for_long_lesson_titles(self):
+        lesson = Lesson(title='L' * 200)
+        self.assertEqual(len(tasks.quiz_title(lesson)), Quiz._meta.get_field('title').max_length)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StreamedAnswerTests(TestCase):
+    """
+    A streamed answer is only cached once Ollama has marked it done.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        course = Course.objects.create(title='Python', description='A course on Python.')
+        module = Module.objects.create(course=course, title='Basics', description='Learn the basics.')
+        cls.lesson = Lesson.objects.create(module=module, title='Variables', content='Variables hold values.')
+
+    def setUp(self):
+        cache.clear()
+
+    async def ask(self, *lines):
+        """
+        Streams a question through ai_assistant against a faked Ollama reply and returns the body.
+        """
+        body = b''.join(orjson.dumps(line) + b'\n' for line in lines)
+        client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, content=body)))
+        with mock.patch.object(tasks, 'get_ollama_async_client', return_value=client):
+            response = await self.async_client.post(
+                reverse('tutor:ai_assistant'),
+                orjson.dumps({'message': 'What is a variable?', 'stream': True, 'context': {'lesson_id': self.lesson.id}}),
+                content_type='application/json'
+            )
+            return b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+    async def cached_answer(self):
+        response = await self.async_client.post(
+            reverse('tutor:ai_assistant'),
+            orjson.dumps({'message': 'What is a variable?', 'context': {'lesson_id': self.lesson.id}}),
+            content_type='application/json'
+        )
+        return orjson.loads(response.content)['response']
+
+    async def test_complete_answer_is_cached(self):
+        answer = await self.ask({'response': 'A named '}, {'response': 'value.'}, {'response': '', 'done': True})
+        self.assertEqual(answer, 'A named value.')
+        self.assertEqual(await self.cached_answer(), 'A named value.')
+
+    async def test_error_line_ends_the_stream_without_caching(self):
+        answer = await self.ask({'response': 'A named '}, {'error': 'model crashed'})
+        self.assertTrue(answer.startswith('A named '))
+        self.assertIn('Sorry, the AI service is unavailable right now.', answer)
+        with mock.patch('tutor.views.acall_ollama', return_value={'response': 'Fresh answer.'}):
+            self.assertEqual(await self.cached_answer(), 'Fresh answer.')
+
+    async def test_stream_without_done_line_is_not_cached(self):
+        answer = await self.ask({'response': 'A named '})
+        self.assertIn('Sorry, the AI service is unavailable right now.', answer)
+        with mock.patch('tutor.views.acall_ollama', return_value={'response': 'Fresh answer.'}):
+            self.assertEqual(await self.cached_answer(), 'Fresh answer.')
+
+
+class ChoiceDisplayOrderTests(TestCase):
+    """
+    Choices created one at a time, as in the admin, are still shuffled.
+    """
+
+    def test_choices_get_a_random_display_order(self):
+        course = Course.objects.create(title='Python', description='A course on Python.')
+        module = Module.objects.create(course=course, title='Basics')
+        lesson = Lesson.objects.create(module=module, title='Variables')
+        question = Question.objects.create(quiz=Quiz.objects.create(lesson=lesson, title='Quiz'), question_text='Which one?')
+        with mock.patch('tutor.models.random.randint', side_effect=[7, 3, 5]):
+            choices = [Choice.objects.create(question=question, choice_text=text) for text in 'ABC']
+        self.assertEqual([choice.display_order for choice in choices], [7, 3, 5])
+        self.assertEqual(list(question.choices.values_list('choice_text', flat=True)), ['B', 'C', 'A'])
+
+    def test_display_order_is_not_editable_in_the_admin(self):
+        self.assertFalse(Choice._meta.get_field('display_order').editable)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class LessonTextGenerationTests(TestCase):
+    """
+    Only one request generates a lesson's simplified version; the others are told it is on its way.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        course = Course.objects.create(title='Python', description='A course on Python.')
+        module = Module.objects.create(course=course, title='Basics')
+        cls.lesson = Lesson.objects.create(module=module, title='Variables', content='Variables hold values.')
+
+    def setUp(self):
+        cache.clear()
+        self.model = mock.Mock()
+        self.model.generate_content.return_value.text = ' Variables are named boxes. '
+        patcher = mock.patch('tutor.views.get_gemini_model', return_value=self.model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_concurrent_request_gets_a_pending_placeholder(self):
+        with generation_lock('simplify', self.lesson.id):
+            response = self.client.get(reverse('tutor:simplify_content', args=[self.lesson.id]))
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(response.json()['pending'])
+        self.model.generate_content.assert_not_called()
+
+    def test_text_is_generated_once_and_stored(self):
+        url = reverse('tutor:simplify_content', args=[self.lesson.id])
+        self.assertEqual(self.client.get(url).json(), {'content': 'Variables are named boxes.'})
+        self.assertEqual(self.client.get(url).json(), {'content': 'Variables are named boxes.'})
+        self.model.generate_content.assert_called_once()
+        self.lesson.refresh_from_db()
+        self.assertEqual(self.lesson.simplified_content, 'Variables are named boxes.')
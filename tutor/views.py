@@ -1,19 +1,41 @@
-import json
-import random
+import httpx
+import orjson
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.db import transaction
-from django.conf import settings
-import google.generativeai as genai
+from django.db.models import Count, FilteredRelation, Prefetch, Q
+from django.core.exceptions import RequestDataTooBig
+from django.core.cache import cache
+from django.utils import timezone
 
-from .models import Course, Module, Lesson, Quiz, Question, Choice, UserProgress, UserQuizAttempt, ModuleProgress
+from .models import Course, Module, Lesson, Quiz, Choice, UserProgress, UserQuizAttempt, ModuleProgress
+from .caching import (
+    AI_ANSWER_TIMEOUT, COURSE_CACHE_TIMEOUT, COURSE_LIST_KEY, QUIZ_PAYLOAD_TIMEOUT,
+    ai_answer_key, course_detail_key, generation_lock, quiz_payload_key,
+)
 
-from .tasks import generate_lesson_content, generate_modules_and_lessons
+from .tasks import acall_ollama, astream_ollama, generate_lesson_content, generate_modules_and_lessons, get_gemini_model
 
-genai.configure(api_key=settings.GEMINI_API_KEY)
+# Upper bound on the answers accepted in a single quiz submission
+MAX_QUIZ_ANSWERS = 200
 
+# None of the JSON endpoints needs more than a short message or a quiz's answers
+MAX_JSON_BODY_BYTES = 64 * 1024
+
+def _load_json_body(request, max_bytes=MAX_JSON_BODY_BYTES):
+    """
+    Parses the JSON body of a request. Oversized bodies are rejected with RequestDataTooBig,
+    going by Content-Length before the body is read; invalid JSON raises orjson.JSONDecodeError.
+    """
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+    if content_length > max_bytes or len(request.body) > max_bytes:
+        raise RequestDataTooBig(f"Request body exceeds {max_bytes} bytes.")
+    return orjson.loads(request.body)
 
 # New view to render the dedicated "Create Course" page
 def create_course_page(request):
@@ -27,7 +49,7 @@ def create_course(request):
     and dispatches a background task to generate the actual content.
     """
     try:
-        data = json.loads(request.body)
+        data = _load_json_body(request)
         topic = data.get('topic', 'Unnamed Topic')
 
         # --- Step 1: Create a placeholder Course object ---
@@ -43,6 +65,8 @@ def create_course(request):
         # --- Step 3: Return an immediate response ---
         return JsonResponse({'success': True, 'course_id': course.id})
 
+    except RequestDataTooBig:
+        return JsonResponse({'error': 'Request body too large.'}, status=413)
     except Exception as e:
         # Catches critical errors
         return JsonResponse({'error': f'A critical error occurred: {str(e)}'}, status=500)
@@ -50,19 +74,51 @@ def create_course(request):
 
 
 def course_list(request):
-    courses = Course.objects.all().order_by('-created_at')
+    courses = cache.get(COURSE_LIST_KEY)
+    if courses is None:
+        courses = list(Course.objects.all().order_by('-created_at'))
+        cache.set(COURSE_LIST_KEY, courses, COURSE_CACHE_TIMEOUT)
     return render(request, 'tutor/course_list.html', {'courses': courses})
 
 def course_detail(request, course_id):
-    course = get_object_or_404(Course, id=course_id)
+    key = course_detail_key(course_id)
+    cached = cache.get(key)
+    if cached is None:
+        course = get_object_or_404(Course.objects.only('id', 'title', 'description'), id=course_id)
+        # Lessons are prefetched so the cached modules can render their lesson count and first lesson
+        lessons = Lesson.objects.only('id', 'title', 'order', 'module_id')
+        modules = list(course.modules.order_by('order').prefetch_related(Prefetch('lessons', queryset=lessons)))
+        cached = (course, modules)
+        cache.set(key, cached, COURSE_CACHE_TIMEOUT)
+    course, modules = cached
     return render(request, 'tutor/course_detail.html', {
         'course': course,
-        'modules': course.modules.all().order_by('order'),
+        'modules': modules,
     })
 
+def _adjacent_lesson(course_id, module_order, lesson_order, forward=True):
+    """
+    Returns the id and module_id of the lesson that follows (or precedes) the given
+    position in the course, ordered by module order then lesson order, or None at either end.
+    """
+    if forward:
+        position = Q(module__order__gt=module_order) | Q(module__order=module_order, order__gt=lesson_order)
+        ordering = ('module__order', 'order')
+    else:
+        position = Q(module__order__lt=module_order) | Q(module__order=module_order, order__lt=lesson_order)
+        ordering = ('-module__order', '-order')
+    return (
+        Lesson.objects.filter(position, module__course_id=course_id)
+        .order_by(*ordering)
+        .values('id', 'module_id')
+        .first()
+    )
+
 def lesson_detail(request, course_id, module_id, lesson_id):
+    # The reverse one-to-one join also caches a missing quiz, so hasattr(lesson, 'quiz') needs no query
     lesson = get_object_or_404(
-        Lesson, id=lesson_id, module_id=module_id, module__course_id=course_id
+        Lesson.objects.select_related('module__course', 'quiz'),
+        id=lesson_id, module_id=module_id, module__course_id=course_id
     )
 
     if not request.session.session_key:
@@ -90,10 +146,12 @@ def lesson_detail(request, course_id, module_id, lesson_id):
         session_key=session_key,
         lesson=lesson
     )
-    all_lessons = list(Lesson.objects.filter(module__course_id=course_id).order_by('module__order', 'order'))
-    current_index = all_lessons.index(lesson)
-    next_lesson = all_lessons[current_index + 1] if current_index + 1 < len(all_lessons) else None
-    prev_lesson = all_lessons[current_index - 1] if current_index > 0 else None
+    next_lesson = _adjacent_lesson(course_id, lesson.module.order, lesson.order)
+    prev_lesson = _adjacent_lesson(course_id, lesson.module.order, lesson.order, forward=False)
+
+    # Sidebar outline: one query for the modules, one for their lessons, without lesson content
+    outline_lessons = Lesson.objects.only('id', 'title', 'order', 'module_id')
+    modules = lesson.module.course.modules.order_by('order').prefetch_related(Prefetch('lessons', queryset=outline_lessons))
 
     module_progress = ModuleProgress.objects.filter(
         session_key=session_key,
@@ -103,6 +161,7 @@ def lesson_detail(request, course_id, module_id, lesson_id):
     return render(request, 'tutor/lesson_detail.html', {
         'course': lesson.module.course,
         'module': lesson.module,
+        'modules': modules,
         'lesson': lesson,
         'progress': progress,
         'next_lesson': next_lesson,
@@ -112,26 +171,43 @@ def lesson_detail(request, course_id, module_id, lesson_id):
     })
 
 def quiz_detail(request, quiz_id):
-    quiz = get_object_or_404(Quiz, id=quiz_id)
-    questions = quiz.questions.all().order_by('order')
-    
-    quiz_data = []
-    for question in questions:
-        choices = [
-            {'id': choice.id, 'text': choice.choice_text}
-            for choice in question.choices.all()
-        ]
-        random.shuffle(choices)
-        quiz_data.append({
-            'id': question.id,
-            'text': question.question_text,
-            'explanation': question.explanation,
-            'choices': choices
-        })
+    # The breadcrumbs need the lesson, module and course, but only their ids and titles
+    quiz = get_object_or_404(
+        Quiz.objects.select_related('lesson__module__course').only(
+            'id', 'title', 'description',
+            'lesson__id', 'lesson__title', 'lesson__module_id',
+            'lesson__module__id', 'lesson__module__course_id',
+            'lesson__module__course__id', 'lesson__module__course__title',
+        ),
+        id=quiz_id
+    )
+
+    # The serialized questions are cached with their count; choices come back already in their stored random order
+    key = quiz_payload_key(quiz_id)
+    cached = cache.get(key)
+    if cached is None:
+        choices = Choice.objects.only('id', 'choice_text', 'question_id')
+        questions = list(quiz.questions.order_by('order').prefetch_related(Prefetch('choices', queryset=choices)))
+        quiz_data = orjson.dumps([
+            {
+                'id': question.id,
+                'text': question.question_text,
+                'explanation': question.explanation,
+                'choices': [
+                    {'id': choice.id, 'text': choice.choice_text}
+                    for choice in question.choices.all()
+                ]
+            }
+            for question in questions
+        ]).decode()
+        cached = (quiz_data, len(questions))
+        cache.set(key, cached, QUIZ_PAYLOAD_TIMEOUT)
+    quiz_data, question_count = cached
     
     return render(request, 'tutor/quiz_detail.html', {
         'quiz': quiz,
-        'quiz_data': json.dumps(quiz_data),
+        'quiz_data': quiz_data,
+        'question_count': question_count,
         'lesson': quiz.lesson
     })
 
@@ -139,35 +215,40 @@ def quiz_detail(request, quiz_id):
 @require_http_methods(["POST"])
 def submit_quiz(request, quiz_id):
     try:
-        data = json.loads(request.body)
-        quiz = Quiz.objects.get(id=quiz_id)
+        data = _load_json_body(request)
         answers = data.get('answers', {})
-        
-        total_questions = quiz.questions.count()
+
+        # Reject malformed or oversized submissions before touching the database
+        if not isinstance(answers, dict) or len(answers) > MAX_QUIZ_ANSWERS:
+            return JsonResponse({'success': False, 'error': 'Invalid answers.'}, status=400)
+
+        quiz = Quiz.objects.filter(id=quiz_id).first()
+        if quiz is None:
+            return JsonResponse({'success': False, 'error': 'Quiz not found.'}, status=404)
+
+        # A single query maps every question of the quiz to its correct choice id (None if it has none)
+        correct_choices = {
+            str(question_id): correct_choice_id
+            for question_id, correct_choice_id in quiz.questions.values_list('id', 'correct_choice_id')
+        }
+
+        total_questions = len(correct_choices)
         correct_answers = 0
-        
+
         for question_id, choice_id in answers.items():
-            try:
-                question = Question.objects.get(id=question_id, quiz=quiz)
-                correct_choice = question.choices.get(is_correct=True)
-                if str(correct_choice.id) == choice_id:
-                    correct_answers += 1
-            except (Question.DoesNotExist, Choice.DoesNotExist):
-                pass
-        
+            correct_choice_id = correct_choices.get(question_id)
+            if correct_choice_id is not None and str(correct_choice_id) == choice_id:
+                correct_answers += 1
+
         score = (correct_answers / total_questions) * 100 if total_questions > 0 else 0
         
-        UserQuizAttempt.objects.create(
-            session_key=request.session.session_key or 'anonymous',
-            quiz=quiz,
-            score=score
-        )
-        
-        if score >= 70:
-            UserProgress.objects.update_or_create(
+        # The post_save handler of UserQuizAttempt marks the lesson complete on a pass,
+        # so the attempt and the progress update are committed together
+        with transaction.atomic():
+            UserQuizAttempt.objects.create(
                 session_key=request.session.session_key or 'anonymous',
-                lesson=quiz.lesson,
-                defaults={'completed': True}
+                quiz=quiz,
+                score=score
             )
         
         return JsonResponse({
@@ -178,24 +259,56 @@ def submit_quiz(request, quiz_id):
             'passed': score >= 70
         })
     
+    except RequestDataTooBig:
+        return JsonResponse({'success': False, 'error': 'Request body too large.'}, status=413)
     except Exception as e:
         return JsonResponse({
             'success': False,
             'error': str(e)
         }, status=400)
 
+async def _stream_ai_answer(key, prompt, cached_text):
+    """
+    Yields a cached answer in one piece, or streams a fresh one from Ollama and caches
+    it once complete. astream_ollama only returns normally after Ollama's "done" line,
+    so an answer cut short by an error is never cached.
+    """
+    if cached_text is not None:
+        yield cached_text
+        return
+
+    chunks = []
+    try:
+        async for chunk in astream_ollama(prompt):
+            chunks.append(chunk)
+            yield chunk
+    # The 200 headers are already sent, so any failure mid-stream ends the body with a message instead
+    except (httpx.HTTPError, httpx.StreamError, ValueError) as e:
+        print(f"Error streaming from Ollama: {e}")
+        yield "\n\nSorry, the AI service is unavailable right now."
+        return
+
+    if chunks:
+        await cache.aset(key, ''.join(chunks), AI_ANSWER_TIMEOUT)
+
 @csrf_exempt
 @require_http_methods(["POST"])
-def ai_assistant(request):
+async def ai_assistant(request):
+    """
+    Answers a question about a lesson. This is an async view so that, under ASGI,
+    requests waiting on the model don't each hold a worker thread.
+    """
     try:
-        data = json.loads(request.body)
+        data = _load_json_body(request)
         message = data.get('message', '').strip()
         lesson_id = data.get('context', {}).get('lesson_id')
 
         if not message or not lesson_id:
             return JsonResponse({'error': 'Message and lesson_id are required'}, status=400)
 
-        lesson = get_object_or_404(Lesson, id=lesson_id)
+        lesson = await Lesson.objects.only('id', 'content', 'updated_at').filter(id=lesson_id).afirst()
+        if lesson is None:
+            return JsonResponse({'error': 'Lesson not found'}, status=404)
 
         context_text = lesson.content
 
@@ -208,16 +321,35 @@ def ai_assistant(request):
         User Question: {message}
         '''
         
-        response_json = call_ollama(prompt)
-        response_text = response_json.get('response', 'Sorry, I could not generate a response.')
+        # Repeated questions on an unchanged lesson are answered from the cache
+        key = ai_answer_key(lesson, message)
+        response_text = await cache.aget(key)
+        if response_text is not None:
+            await cache.atouch(key, AI_ANSWER_TIMEOUT)
+
+        # Clients that ask for it get the answer as plain text, streamed as the model writes it
+        if data.get('stream'):
+            return StreamingHttpResponse(
+                _stream_ai_answer(key, prompt, response_text),
+                content_type='text/plain; charset=utf-8'
+            )
 
+        if response_text is None:
+            response_json = await acall_ollama(prompt)
+            response_text = response_json.get('response')
+            if response_text:
+                await cache.aset(key, response_text, AI_ANSWER_TIMEOUT)
+            else:
+                response_text = 'Sorry, I could not generate a response.'
 
         return JsonResponse({
             'response': response_text,
             'context': data.get('context', {})
         })
         
-    except json.JSONDecodeError:
+    except RequestDataTooBig:
+        return JsonResponse({'error': 'Request body too large.'}, status=413)
+    except orjson.JSONDecodeError:
         return JsonResponse({'error': 'Invalid JSON'}, status=400)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
@@ -234,49 +366,75 @@ def delete_course(request, course_id):
 
 @require_http_methods(["POST"])
 def mark_lesson_complete(request, lesson_id):
-    lesson = get_object_or_404(Lesson, id=lesson_id)
+    # Only the columns needed for the module check and the redirect, as a plain dict
+    lesson = Lesson.objects.filter(id=lesson_id).values(
+        'id', 'order', 'module_id', 'module__order', 'module__course_id'
+    ).first()
+    if lesson is None:
+        raise Http404("Lesson not found.")
+    module_id = lesson['module_id']
+    course_id = lesson['module__course_id']
     
     if not request.session.session_key:
         request.session.create()
     session_key = request.session.session_key
 
-    # Mark the current lesson as complete
+    # Mark the current lesson as complete, skipping the write if it already is
     progress, created = UserProgress.objects.get_or_create(
         session_key=session_key,
-        lesson=lesson
+        lesson_id=lesson['id'],
+        defaults={'completed': True}
     )
-    progress.completed = True
-    progress.save()
+    if not created and not progress.completed:
+        UserProgress.objects.filter(pk=progress.pk).update(completed=True, last_reviewed=timezone.now())
     
-    # Check if this completes the module
-    module = lesson.module
-    all_lessons_in_module = module.lessons.all()
-    completed_lessons_count = UserProgress.objects.filter(
-        session_key=session_key,
-        lesson__in=all_lessons_in_module,
-        completed=True
-    ).count()
+    # Check if this completes the module, counting its lessons and the completed ones in one query.
+    # The join only matches this session's completed progress, at most one row per lesson
+    lesson_counts = Lesson.objects.filter(module_id=module_id).annotate(
+        session_progress=FilteredRelation(
+            'user_progress',
+            condition=Q(user_progress__session_key=session_key, user_progress__completed=True)
+        )
+    ).aggregate(total=Count('id'), completed=Count('session_progress'))
     
-    if completed_lessons_count >= all_lessons_in_module.count():
+    if lesson_counts['completed'] >= lesson_counts['total']:
         ModuleProgress.objects.update_or_create(
             session_key=session_key,
-            module=module,
+            module_id=module_id,
             defaults={'completed': True}
         )
 
     # Determine the next lesson
-    all_course_lessons = list(Lesson.objects.filter(module__course_id=lesson.module.course.id).order_by('module__order', 'order'))
-    current_index = all_course_lessons.index(lesson)
-    next_lesson = all_course_lessons[current_index + 1] if current_index + 1 < len(all_course_lessons) else None
+    next_lesson = _adjacent_lesson(course_id, lesson['module__order'], lesson['order'])
 
     if next_lesson:
-        return redirect('tutor:lesson_detail', course_id=next_lesson.module.course.id, module_id=next_lesson.module.id, lesson_id=next_lesson.id)
+        return redirect('tutor:lesson_detail', course_id=course_id, module_id=next_lesson['module_id'], lesson_id=next_lesson['id'])
     else:
         # If there are no more lessons, redirect to the course detail page
-        return redirect('tutor:course_detail', course_id=lesson.module.course.id)
+        return redirect('tutor:course_detail', course_id=course_id)
 
 # --- New Views for Simplify and Example ---
 
+def _generate_lesson_text(lesson, field, kind, prompt, pending_message):
+    """
+    Generates the lesson's `field` from `prompt` with Gemini, stores it and returns it as JSON.
+    Only one request per lesson calls Gemini at a time; the others get a 202 with
+    `pending_message` and `pending: true`, so the page can show it and ask again.
+    """
+    with generation_lock(kind, lesson.id) as acquired:
+        if not acquired:
+            return JsonResponse({'content': pending_message, 'pending': True}, status=202)
+
+        # A previous holder of the lock may have finished it since the lesson was loaded
+        lesson.refresh_from_db(fields=[field])
+        if getattr(lesson, field):
+            return JsonResponse({'content': getattr(lesson, field)})
+
+        text = get_gemini_model().generate_content(prompt).text.strip()
+        setattr(lesson, field, text)
+        lesson.save()
+        return JsonResponse({'content': text})
+
 @require_http_methods(["GET"])
 def simplify_content(request, lesson_id):
     try:
@@ -288,20 +446,16 @@ def simplify_content(request, lesson_id):
         if not lesson.content:
             return JsonResponse({'content': 'Cannot simplify an empty lesson.'})
 
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
         prompt = f"""
         Simplify the following lesson content for a beginner. Focus on core concepts, use simple language, and keep it concise.
         Lesson Title: {lesson.title}
         Lesson Content:
         {lesson.content}
         """
-        response = model.generate_content(prompt)
-        simplified_text = response.text.strip()
-        
-        lesson.simplified_content = simplified_text
-        lesson.save()
-        
-        return JsonResponse({'content': simplified_text})
+        return _generate_lesson_text(
+            lesson, 'simplified_content', 'simplify', prompt,
+            'The simplified version is being generated. It will appear here in a moment.'
+        )
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
@@ -316,19 +470,15 @@ def generate_example(request, lesson_id):
         if not lesson.content:
              return JsonResponse({'content': 'Cannot generate an example for an empty lesson.'})
 
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
         prompt = f"""
         Provide a clear and practical example for the following lesson content. Focus on demonstrating the main concepts in a concise way.
         Lesson Title: {lesson.title}
         Lesson Content:
         {lesson.content}
         """
-        response = model.generate_content(prompt)
-        example_text = response.text.strip()
-        
-        lesson.example_content = example_text
-        lesson.save()
-        
-        return JsonResponse({'content': example_text})
+        return _generate_lesson_text(
+            lesson, 'example_content', 'example', prompt,
+            'A relevant example is being generated. It will appear here in a moment.'
+        )
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
\ No newline at end of file
+        return JsonResponse({'error': str(e)}, status=500)